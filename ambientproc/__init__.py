@@ -26,5 +26,6 @@ __all__ = [
     'render_specific_material_canonical',
 
     'AmbientDataset',
+    'AmbientIterableDataset',
     'AmbientDataConfig'
 ]
\ No newline at end of file
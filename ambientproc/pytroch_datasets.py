@@ -1,7 +1,9 @@
 import pickle
+import random
 import shutil
 
 import torch
+import torch.distributed as dist
 import torch.utils.data as data
 import torchvision.transforms as transforms
 import lmdb
@@ -60,15 +62,23 @@ class AmbientDataset(data.Dataset):
 
     def __getitem__(self, index):
         key = self.raw_keys[index]
-        sample = {}
         with self.env.begin(write=False) as txn:
-            for pair in self.cfg.fetch_pairs:
-                if pair[0] in self.cfg.use_rendered_types and pair[1] in self.cfg.use_data_types:
-                       sample[pair] = self.fetch_data_pair(key, txn, pair[0], pair[1])
-                       if self.post_transform is not None:
-                            sample_0 = self.post_transform(sample[pair][0])
-                            sample_1 = self.post_transform(sample[pair][1])
-                            sample[pair] = (sample_0, sample_1)
+            return self.build_sample(pickle.loads(txn.get(key)))
+
+    def build_sample(self, data):
+        """
+        builds a sample dict from an unpickled lmdb value, applying post_transform
+        :param data: unpickled lmdb value
+        :return: dictionary of (modality1, modality2) -> (tensor1, tensor2)
+        """
+        sample = {}
+        for pair in self.cfg.fetch_pairs:
+            if pair[0] in self.cfg.use_rendered_types and pair[1] in self.cfg.use_data_types:
+                   sample[pair] = self.decode_data_pair(data, pair[0], pair[1])
+                   if self.post_transform is not None:
+                        sample_0 = self.post_transform(sample[pair][0])
+                        sample_1 = self.post_transform(sample[pair][1])
+                        sample[pair] = (sample_0, sample_1)
 
         return sample
 
@@ -205,7 +215,16 @@ class AmbientDataset(data.Dataset):
         :param txn: lmdb transaction
         :return: dictionary of data
         """
-        data = pickle.loads(txn.get(key))
+        return self.decode_data_pair(pickle.loads(txn.get(key)), modality1, modality2)
+
+    def decode_data_pair(self, data, modality1, modality2):
+        """
+        converts a pair of modalities of an unpickled lmdb value to float tensors
+        :param data: unpickled lmdb value
+        :param modality1:
+        :param modality2:
+        :return: tuple of torch tensors
+        """
         if modality1 not in data.keys():
             raise ValueError("Modality {} not in data".format(modality1))
 
@@ -214,3 +233,185 @@ class AmbientDataset(data.Dataset):
                      self.cfg.resolution[0], self.cfg.resolution[1]), dtype=np.uint8)
 
         return torch.tensor(data[modality1], dtype=torch.float32), torch.tensor(data[modality2],  dtype=torch.float32)
+
+
+class AmbientIterableDataset(data.IterableDataset):
+    """
+    streams the lmdb with sequential cursor scans (readahead enabled) instead of one random txn.get per index,
+    which keeps slow storage (spinning disks, network filesystems) bandwidth bound rather than IOPS bound.
+    the keys are cut into chunks of chunk_size consecutive keys, the chunk order is shuffled every epoch and the
+    chunks are dealt out to the shards (one per rank and DataLoader worker), so each chunk is still one sequential
+    scan. samples are then shuffled through a buffer of shuffle_buffer_size entries and yielded as the same sample
+    dicts as AmbientDataset. every rank yields len(self) samples per epoch, so all ranks run the same number of
+    batches under DDP.
+
+    call set_epoch before every epoch, with persistent_workers=False: the DataLoader workers only see the epoch
+    (and resume state) of the dataset copy they were started with.
+
+    each buffer entry holds one pickled lmdb value, i.e. every channel of a sample as uint8 at cfg.resolution
+    (about 12 MB for the 12 channels at 1024x1024 of ambientCFG.json), per DataLoader worker and rank.
+
+    with return_positions=True every sample is yielded as (sample, (shard, consumed)), where consumed is the number
+    of samples that shard has yielded so far in this epoch. collect the latest consumed per shard into
+    {"epoch": epoch, "num_shards": num_shards, "consumed": {shard: consumed}} and pass it to load_state_dict
+    to resume every shard from its own position. each rank only sees the positions of its own shards, so under
+    DDP the positions have to be gathered across ranks (e.g. dist.all_gather_object) before saving the state.
+    """
+    def __init__(self, cfg: AmbientDataConfig, redo_lmdb=False, post_transform=None,
+                 shuffle_buffer_size=16, chunk_size=16, seed=0, return_positions=False):
+        """
+        :param cfg: AmbientDataConfig
+        :param redo_lmdb: remake the lmdb before streaming
+        :param post_transform: transformation applied to each tensor of a pair
+        :param shuffle_buffer_size: number of samples held for shuffling, <= 1 disables shuffling
+        :param chunk_size: number of consecutive keys read in one sequential scan
+        :param seed: base seed of the chunk order and the shuffle buffer, combined with the epoch and shard
+        :param return_positions: yield (sample, (shard, consumed)) instead of sample, for resuming
+        """
+        super(AmbientIterableDataset, self).__init__()
+
+        # reuse the map style dataset for building the lmdb, listing the keys and decoding the samples
+        self.base = AmbientDataset(cfg, redo_lmdb=redo_lmdb, post_transform=post_transform)
+        self.base.env.close()
+        self.base.env = None
+
+        self.cfg = cfg
+        self.LMDB_PATH = self.base.LMDB_PATH
+        self.raw_keys = self.base.raw_keys
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.return_positions = return_positions
+        self.epoch = 0
+        self.resume_state = None
+
+    def __len__(self):
+        return len(self.raw_keys) // self.get_rank()[1]
+
+    def set_epoch(self, epoch):
+        """
+        sets the epoch, changing the chunk order and the shuffle order of the next iteration.
+        has to be called before every epoch and does not reach workers started with persistent_workers=True
+        :param epoch: epoch number
+        """
+        self.epoch = epoch
+
+        # a resume state applies to every iteration of the epoch it was saved in, until the epoch changes
+        if self.resume_state is not None and self.resume_state["epoch"] != epoch:
+            self.resume_state = None
+
+    def load_state_dict(self, state):
+        """
+        resumes the iterations of the saved epoch from the positions collected with return_positions=True
+        :param state: {"epoch": epoch, "num_shards": number of shards, "consumed": {shard: samples yielded}},
+                      gathered from all ranks
+        """
+        # shard indices turn into strings when the state is saved as json
+        consumed = {int(shard): count for shard, count in state["consumed"].items()}
+        if set(consumed.keys()) != set(range(state["num_shards"])):
+            raise ValueError("Resume state has positions for shards {}, but needs all of the {} shards".format(
+                sorted(consumed.keys()), state["num_shards"]))
+
+        self.epoch = state["epoch"]
+        self.resume_state = {"epoch": state["epoch"], "num_shards": state["num_shards"], "consumed": consumed}
+
+    def get_rank(self):
+        """
+        :return: (rank, world size) of the distributed process group, (0, 1) when not distributed
+        """
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def get_shard(self):
+        """
+        shuffles the chunk order for the current epoch and splits it across ranks and DataLoader workers
+        :return: (shard index, number of shards, list of keys of this shard in reading order)
+        """
+        rank, world_size = self.get_rank()
+
+        worker_id, num_workers = 0, 1
+        worker_info = data.get_worker_info()
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        rng = random.Random("{}_{}".format(self.seed, self.epoch))
+        chunks = [self.raw_keys[i: i + self.chunk_size] for i in range(0, len(self.raw_keys), self.chunk_size)]
+        rng.shuffle(chunks)
+        keys = [key for chunk in chunks for key in chunk]
+
+        # every rank gets the same number of keys, so all ranks run the same number of batches under DDP.
+        # the (less than world_size) keys left over change with the chunk order of each epoch
+        rank_len = len(keys) // world_size
+        keys = keys[rank * rank_len: (rank + 1) * rank_len]
+
+        num_shards = world_size * num_workers
+        shard = rank * num_workers + worker_id
+        return shard, num_shards, keys[rank_len * worker_id // num_workers: rank_len * (worker_id + 1) // num_workers]
+
+    def get_schedule(self, keys, rng):
+        """
+        runs the shuffle buffer on the keys alone, which makes the yield order reproducible for resuming
+        :param keys: keys of the shard in reading order
+        :param rng: random.Random of the shard
+        :return: list of (number of keys read before the yield, yielded key)
+        """
+        if self.shuffle_buffer_size <= 1:
+            return [(i + 1, key) for i, key in enumerate(keys)]
+
+        schedule = []
+        buffer = []
+        for i, key in enumerate(keys):
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(key)
+            else:
+                index = rng.randrange(len(buffer))
+                buffer[index], key = key, buffer[index]
+                schedule.append((i + 1, key))
+
+        rng.shuffle(buffer)
+        schedule.extend((len(keys), key) for key in buffer)
+        return schedule
+
+    def __iter__(self):
+        shard, num_shards, keys = self.get_shard()
+
+        consumed = 0
+        if self.resume_state is not None:
+            if self.resume_state["num_shards"] != num_shards:
+                raise ValueError("Resume state has {} shards, but the dataset is split into {}".format(
+                    self.resume_state["num_shards"], num_shards))
+            consumed = self.resume_state["consumed"][shard]
+
+        schedule = self.get_schedule(keys, random.Random("{}_{}_{}".format(self.seed, self.epoch, shard)))
+        if consumed >= len(schedule):
+            return
+        read = schedule[consumed - 1][0] if consumed > 0 else 0
+
+        # open the environment in the worker process, lmdb environments must not be shared across forks
+        env = lmdb.open(self.LMDB_PATH, readonly=True, lock=False, readahead=True, meminit=False)
+        try:
+            with env.begin(write=False) as txn:
+                # values that were read before the resume position but still waiting in the shuffle buffer
+                read_keys = set(keys[:read])
+                pending = {key: txn.get(key) for _, key in schedule[consumed:] if key in read_keys}
+
+                cursor = txn.cursor()
+                for position in range(consumed, len(schedule)):
+                    num_read, key = schedule[position]
+                    while read < num_read:
+                        next_key = keys[read]
+                        # keep scanning sequentially inside a chunk, only seek when the next chunk starts
+                        if not (cursor.next() and cursor.key() == next_key):
+                            if not cursor.set_key(next_key):
+                                raise KeyError("Key {} not in lmdb".format(next_key))
+                        pending[next_key] = cursor.value()
+                        read += 1
+
+                    sample = self.base.build_sample(pickle.loads(pending.pop(key)))
+                    if self.return_positions:
+                        yield sample, (shard, position + 1)
+                    else:
+                        yield sample
+        finally:
+            env.close()
@@ -0,0 +1,138 @@
+import collections
+import json
+import os
+import pickle
+
+import lmdb
+import numpy as np
+import pytest
+import torch
+import torch.utils.data as data
+
+from ambientproc import AmbientDataConfig, AmbientDataset, AmbientIterableDataset
+
+NUM_KEYS = 51
+
+
+def sample_id(sample):
+    """
+    recovers the index a sample was written with from the values of its canonical render and roughness
+    """
+    render, roughness = sample[("canonical_render", "roughness")]
+    return int(render[0, 0, 0]) + 251 * int(roughness[0, 0, 0])
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    cfg = AmbientDataConfig({
+        "root_dir": str(tmp_path),
+        "lmdb_dir": "lmdb",
+        "lmdb_name": "test_lmdb",
+        "cache_dir": "cache",
+        "dataset_dir": "dataset",
+        "generate_data_per_sample": 1,
+        "fetch_pairs": [["canonical_render", "roughness"], ["canonical_render", "normal"]],
+        "use_rendered_types": ["canonical_render"],
+        "use_data_types": ["roughness", "normal"],
+        "fitting_method": "RESIZE",
+        "resolution": [4, 4],
+    })
+
+    # write a tiny lmdb directly, so the dataset does not build one from the dataset dir
+    os.mkdir(cfg.lmdb_dir)
+    env = lmdb.open(os.path.join(cfg.lmdb_dir, cfg.lmdb_name), map_size=1 << 24)
+    with env.begin(write=True) as txn:
+        for i in range(NUM_KEYS):
+            material_data = {
+                "canonical_render": np.full((3, 4, 4), i % 251, dtype=np.uint8),
+                "roughness": np.full((1, 4, 4), i // 251, dtype=np.uint8),
+            }
+            txn.put("material{:03d}_0".format(i).encode(), pickle.dumps(material_data))
+    env.close()
+    return cfg
+
+
+def test_samples_match_map_style_dataset(cfg):
+    dataset = AmbientIterableDataset(cfg, shuffle_buffer_size=8, chunk_size=4)
+    samples = list(dataset)
+    assert len(samples) == NUM_KEYS
+
+    # lmdb only allows one open environment per path and process, so open the map style dataset afterwards
+    map_dataset = AmbientDataset(cfg)
+    for sample in samples:
+        expected = map_dataset[sample_id(sample)]
+        assert sample.keys() == expected.keys()
+        for pair in expected:
+            assert torch.equal(sample[pair][0], expected[pair][0])
+            assert torch.equal(sample[pair][1], expected[pair][1])
+
+
+def test_two_workers_yield_each_key_once(cfg):
+    dataset = AmbientIterableDataset(cfg, shuffle_buffer_size=8, chunk_size=4, return_positions=True)
+    loader = data.DataLoader(dataset, batch_size=None, num_workers=2)
+
+    ids = collections.Counter()
+    per_shard = collections.Counter()
+    for sample, (shard, consumed) in loader:
+        ids[sample_id(sample)] += 1
+        per_shard[shard] += 1
+
+    # without distribution the single rank keeps every key, the workers split it between them
+    assert len(dataset) == len(loader) == NUM_KEYS
+    assert per_shard == {0: NUM_KEYS // 2, 1: NUM_KEYS - NUM_KEYS // 2}
+    assert len(ids) == NUM_KEYS
+    assert set(ids.values()) == {1}
+
+
+def test_resume_continues_every_shard(cfg):
+    dataset = AmbientIterableDataset(cfg, shuffle_buffer_size=8, chunk_size=4, return_positions=True)
+    full_order = collections.defaultdict(list)
+    for sample, (shard, _) in data.DataLoader(dataset, batch_size=None, num_workers=2):
+        full_order[shard].append(sample_id(sample))
+
+    # stop partway through, after the shuffle buffers are full
+    consumed = {}
+    order = collections.defaultdict(list)
+    for step, (sample, (shard, position)) in enumerate(data.DataLoader(dataset, batch_size=None, num_workers=2)):
+        if step == 31:
+            break
+        consumed[shard] = position
+        order[shard].append(sample_id(sample))
+
+    resumed = AmbientIterableDataset(cfg, shuffle_buffer_size=8, chunk_size=4, return_positions=True)
+    # the state survives a round trip through json, which turns the shard indices into strings
+    resumed.load_state_dict(json.loads(json.dumps({"epoch": 0, "num_shards": 2, "consumed": consumed})))
+    for sample, (shard, position) in data.DataLoader(resumed, batch_size=None, num_workers=2):
+        order[shard].append(sample_id(sample))
+
+    assert order == full_order
+
+
+def test_resume_state_needs_every_shard(cfg):
+    dataset = AmbientIterableDataset(cfg)
+    with pytest.raises(ValueError):
+        dataset.load_state_dict({"epoch": 0, "num_shards": 2, "consumed": {0: 20}})
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_resume_state_is_dropped_in_the_next_epoch(cfg, num_workers):
+    dataset = AmbientIterableDataset(cfg, shuffle_buffer_size=8, chunk_size=4)
+    loader = data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    num_shards = max(num_workers, 1)
+    dataset.load_state_dict({"epoch": 0, "num_shards": num_shards, "consumed": {i: 20 for i in range(num_shards)}})
+
+    dataset.set_epoch(0)
+    assert len(list(loader)) == NUM_KEYS - 20 * num_shards
+
+    dataset.set_epoch(1)
+    epoch_1 = [sample_id(sample) for sample in loader]
+    assert sorted(epoch_1) == list(range(NUM_KEYS))
+
+    dataset.set_epoch(2)
+    epoch_2 = [sample_id(sample) for sample in loader]
+    assert sorted(epoch_2) == list(range(NUM_KEYS))
+    assert epoch_2 != epoch_1
+
+    # going back to the saved epoch does not resume again
+    dataset.set_epoch(0)
+    assert len(list(loader)) == NUM_KEYS